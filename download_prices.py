@@ -4,23 +4,35 @@ Script to download CMS Hospital Price Transparency files from Bay Area hospitals
 Downloads all machine-readable files listed in cost_downloadable_links.csv
 """
 
+import asyncio
+import hashlib
 import os
 import csv
 import re
+import socket
+import threading
 import time
-import requests
+import aiofiles
+import httpx
+import orjson
 from pathlib import Path
 from urllib.parse import urlparse, unquote
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
 
 # Configuration
 CSV_FILE = "cost_downloadable_links.csv"
 OUTPUT_DIR = "public_prices"
-MAX_WORKERS = 5  # Number of parallel downloads
+MAX_WORKERS = 20  # Maximum concurrent downloads across all hosts
 TIMEOUT = 120  # Seconds
-CHUNK_SIZE = 8192  # For streaming large files
+CHUNK_SIZE = 1024 * 1024  # For streaming large files; big chunks amortize per-chunk Python overhead
 RETRY_ATTEMPTS = 3
-DELAY_BETWEEN_REQUESTS = 0.5  # Seconds
+RETRYABLE_STATUSES = {429, 502, 503, 504}  # Transient server-side statuses
+HOST_REQUESTS_PER_SECOND = 2.0  # Per-host token-bucket rate (and burst size)
+LARGE_FILE_THRESHOLD = 100 * 1024 * 1024  # Split downloads above this size into ranges
+RANGE_CHUNKS = 4  # Parallel byte-range requests per large file
+ERROR_DRAIN_LIMIT = 64 * 1024  # Only drain rejected bodies up to this size
+DNS_CACHE_TTL = 300  # Seconds to reuse resolved addresses
+LOG_FSYNC_EVERY = 20  # fsync the result log every N records
 
 # Headers to mimic a browser request
 HEADERS = {
@@ -32,85 +44,311 @@ HEADERS = {
 }
 
 
+# Precompiled patterns; these run for every hospital, so compile once
+_SANITIZE_INVALID = re.compile(r'[<>:"/\\|?*]')
+_SANITIZE_SPACES = re.compile(r'\s+')
+_SANITIZE_NONWORD = re.compile(r'[^\w\-_.]')
+
+
 def sanitize_filename(name: str) -> str:
     """Convert hospital name to a safe filename."""
     # Remove or replace problematic characters
-    name = re.sub(r'[<>:"/\\|?*]', '', name)
-    name = re.sub(r'\s+', '_', name)
-    name = re.sub(r'[^\w\-_.]', '', name)
+    name = _SANITIZE_INVALID.sub('', name)
+    name = _SANITIZE_SPACES.sub('_', name)
+    name = _SANITIZE_NONWORD.sub('', name)
     return name.lower()[:100]  # Limit length
 
 
+# Lookup tables for extension detection; 'api' maps to .json because API
+# endpoints typically return JSON
+_URL_EXTENSIONS = {'.csv': '.csv', '.json': '.json', '.zip': '.zip', '.xlsx': '.xlsx', '.xml': '.xml'}
+_FILE_TYPE_KEYWORDS = (('csv', '.csv'), ('json', '.json'), ('zip', '.zip'), ('api', '.json'))
+_CONTENT_TYPE_KEYWORDS = (('csv', '.csv'), ('json', '.json'), ('zip', '.zip'),
+                          ('excel', '.xlsx'), ('spreadsheet', '.xlsx'), ('xml', '.xml'))
+
+
 def get_extension_from_url(url: str, file_type: str) -> str:
     """Determine file extension from URL or file_type column."""
     # Check URL path first
     parsed = urlparse(url)
     path = unquote(parsed.path)
 
-    if path.endswith('.csv'):
-        return '.csv'
-    elif path.endswith('.json'):
-        return '.json'
-    elif path.endswith('.zip'):
-        return '.zip'
-    elif path.endswith('.xlsx'):
-        return '.xlsx'
-    elif path.endswith('.xml'):
-        return '.xml'
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _URL_EXTENSIONS:
+        return _URL_EXTENSIONS[ext]
 
     # Fall back to file_type column
     file_type_lower = file_type.lower()
-    if 'csv' in file_type_lower:
-        return '.csv'
-    elif 'json' in file_type_lower:
-        return '.json'
-    elif 'zip' in file_type_lower:
-        return '.zip'
-    elif 'api' in file_type_lower:
-        return '.json'  # API endpoints typically return JSON
+    for keyword, mapped_ext in _FILE_TYPE_KEYWORDS:
+        if keyword in file_type_lower:
+            return mapped_ext
 
     # Default to .json for unknown types
     return '.json'
 
 
-def get_extension_from_response(response: requests.Response, default_ext: str) -> str:
+def get_extension_from_response(response: httpx.Response, default_ext: str) -> str:
     """Determine extension from response content-type header."""
     content_type = response.headers.get('Content-Type', '').lower()
 
-    if 'csv' in content_type or 'text/csv' in content_type:
-        return '.csv'
-    elif 'json' in content_type:
+    for keyword, mapped_ext in _CONTENT_TYPE_KEYWORDS:
+        if keyword in content_type:
+            return mapped_ext
+
+    return default_ext
+
+
+# Magic bytes → extension; checked before trusting any response header
+_MAGIC_EXTENSIONS = {
+    b'PK\x03\x04': '.zip',
+    b'<?xm': '.xml',
+    b'<htm': '.html',
+}
+
+
+def sniff_extension(head: bytes, default_ext: str) -> str:
+    """Guess the extension from the first bytes of the body.
+
+    Servers frequently mislabel Content-Type on these files, so the
+    content itself is the most reliable signal.
+    """
+    ext = _MAGIC_EXTENSIONS.get(head[:4])
+    if ext:
+        # xlsx is a zip container, so PK magic alone can't distinguish the
+        # two; keep .xlsx when the URL or headers already said so
+        if ext == '.zip' and default_ext == '.xlsx':
+            return '.xlsx'
+        return ext
+
+    stripped = head.lstrip()
+    if stripped[:1] in (b'{', b'['):
         return '.json'
-    elif 'zip' in content_type or 'application/zip' in content_type:
-        return '.zip'
-    elif 'excel' in content_type or 'spreadsheet' in content_type:
-        return '.xlsx'
-    elif 'xml' in content_type:
+    if stripped[:1] == b'<':
         return '.xml'
 
-    # Check content-disposition header for filename
-    content_disp = response.headers.get('Content-Disposition', '')
-    if 'filename=' in content_disp:
-        match = re.search(r'filename[^;=\n]*=([\'"]?)([^\'"\n]*)\1', content_disp)
-        if match:
-            filename = match.group(2)
-            if '.' in filename:
-                return '.' + filename.split('.')[-1].lower()
+    # A comma-bearing, printable first line is almost certainly a CSV header
+    first_line = stripped.split(b'\n', 1)[0][:4096]
+    if b',' in first_line and all(b >= 32 or b in (9, 13) for b in first_line):
+        return '.csv'
 
     return default_ext
 
 
-def download_file(hospital_name: str, url: str, file_type: str, region: str, output_dir: Path) -> dict:
+class TokenBucket:
+    """Token bucket limiting the request rate against a single host.
+
+    Tokens refill continuously at `rate` per second up to a burst of
+    `rate`, so short bursts are smoothed instead of every request paying
+    a fixed delay regardless of how long the previous transfer took.
+    """
+
+    def __init__(self, rate: float = HOST_REQUESTS_PER_SECOND):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1.0:
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+            # The sleep minted exactly the missing fraction of a token and
+            # it is consumed here; advance `last` so the slept interval is
+            # not re-credited to the next caller
+            self.last = time.monotonic()
+            self.tokens = 0.0
+        else:
+            self.tokens -= 1.0
+
+
+def install_dns_cache(ttl: float = DNS_CACHE_TTL) -> None:
+    """Cache socket.getaddrinfo results so reconnects to the same host skip DNS.
+
+    Many hospitals sit behind a handful of CDN hostnames; once the pool
+    evicts an idle socket, a fresh connection would otherwise re-resolve
+    the same name. The event loop resolves names via socket.getaddrinfo
+    in a thread, so wrapping it here covers all requests.
+    """
+    cache = {}
+    lock = threading.Lock()
+    original = socket.getaddrinfo
+
+    def cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with lock:
+            hit = cache.get(key)
+            if hit is not None and hit[1] > now:
+                return hit[0]
+        addrinfo = original(host, port, family, type, proto, flags)
+        with lock:
+            cache[key] = (addrinfo, now + ttl)
+        return addrinfo
+
+    socket.getaddrinfo = cached_getaddrinfo
+
+
+def create_client() -> httpx.AsyncClient:
+    """Create an async client with a shared connection pool."""
+    limits = httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=MAX_WORKERS,
+    )
+    # http2=True multiplexes all of a host's transfers over one TLS
+    # connection; hosts that only speak HTTP/1.1 fall back transparently
+    return httpx.AsyncClient(
+        http2=True,
+        headers=HEADERS,
+        timeout=TIMEOUT,
+        limits=limits,
+        follow_redirects=True,
+    )
+
+
+def drop_page_cache(filepath: Path) -> None:
+    """Hint the kernel to evict the file's pages from the page cache.
+
+    Multi-GB MRF downloads are written once and read later (if at all),
+    so letting them crowd out hot pages for other processes is pure
+    waste. No-op on platforms without posix_fadvise.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def hash_file(filepath: Path, hasher=None) -> str:
+    """SHA-256 a file already on disk; optionally feed an existing hasher."""
+    hasher = hasher if hasher is not None else hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def load_prior_log(log_path: Path) -> dict:
+    """Load prior downloads from the JSONL log; the last entry per (hospital, url) wins."""
+    prior = {}
+    if log_path.exists():
+        with open(log_path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Torn final line from a crashed run
+                if entry.get('success'):
+                    prior[(entry['hospital'], entry['url'])] = entry
+    return prior
+
+
+class RangeNotHonoredError(httpx.HTTPError):
+    """Raised when a server answers a byte-range request with a non-206 status."""
+
+
+async def download_ranges(client: httpx.AsyncClient, url: str, headers: dict, filepath: Path, content_length: int) -> int:
+    """Fetch one large file as RANGE_CHUNKS parallel byte-range requests."""
+    fd = os.open(filepath, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    try:
+        # Size the file upfront so each range can pwrite at its own offset;
+        # fallocate also reserves real blocks, avoiding piecemeal allocation
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, content_length)
+        else:
+            os.ftruncate(fd, content_length)
+        chunk_len = -(-content_length // RANGE_CHUNKS)  # Ceiling division
+
+        async def fetch_range(start: int, end: int) -> int:
+            range_headers = dict(headers)
+            range_headers['Range'] = f'bytes={start}-{end}'
+            offset = start
+            async with client.stream('GET', url, headers=range_headers) as response:
+                if response.status_code != 206:
+                    # Drain small bodies so the connection returns to the
+                    # pool; a server ignoring Range sends the whole file
+                    # with a 200, where a reconnect beats buffering 100+ MB
+                    reply_length = int(response.headers.get('Content-Length') or 0)
+                    if 0 < reply_length <= ERROR_DRAIN_LIMIT:
+                        await response.aread()
+                    raise RangeNotHonoredError(
+                        f"Expected 206 for range {start}-{end}, got {response.status_code}"
+                    )
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+            return offset - start
+
+        # TaskGroup cancels and awaits the sibling ranges when one fails,
+        # so no task can still be pwriting when the fd is closed below
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tasks = [
+                    tg.create_task(fetch_range(start, min(start + chunk_len, content_length) - 1))
+                    for start in range(0, content_length, chunk_len)
+                ]
+        except BaseExceptionGroup as eg:
+            # Re-raise one underlying error with its original type so the
+            # caller's retry classification still applies
+            raise eg.exceptions[0] from eg
+
+        total = sum(task.result() for task in tasks)
+        if total != content_length:
+            raise httpx.HTTPError(
+                f"Range chunks returned {total} bytes, expected {content_length}"
+            )
+        return total
+    except BaseException:
+        # A truncated-to-full-size partial would confuse the resume logic
+        os.close(fd)
+        fd = -1
+        filepath.unlink(missing_ok=True)
+        raise
+    finally:
+        if fd >= 0:
+            os.close(fd)
+
+
+async def download_file(client: httpx.AsyncClient, hospital_name: str, url: str, file_type: str, region: str, output_dir: Path, prior: dict = None) -> dict:
     """Download a single file and return status."""
     result = {
         "hospital": hospital_name,
         "url": url,
         "success": False,
+        "skipped": False,
         "filename": None,
         "error": None,
-        "size": 0
+        "size": 0,
+        "etag": None,
+        "last_modified": None,
+        "sha256": None
     }
 
+    # Verify the local copy against the logged digest; a missing or corrupt
+    # file forces a full redownload instead of trusting a 304
+    local_ok = False
+    if prior and prior.get('filename'):
+        local_path = output_dir.parent / prior['filename']
+        if local_path.exists():
+            if prior.get('sha256'):
+                local_ok = hash_file(local_path) == prior['sha256']
+            else:
+                local_ok = True
+
+    # Ask the server to skip the body if the file is unchanged since last run
+    request_headers = {}
+    if prior and local_ok:
+        if prior.get('etag'):
+            request_headers['If-None-Match'] = prior['etag']
+        if prior.get('last_modified'):
+            request_headers['If-Modified-Since'] = prior['last_modified']
+
     # Create region subdirectory
     region_dir = output_dir / sanitize_filename(region)
     region_dir.mkdir(parents=True, exist_ok=True)
@@ -119,68 +357,226 @@ def download_file(hospital_name: str, url: str, file_type: str, region: str, out
     base_name = sanitize_filename(hospital_name)
     expected_ext = get_extension_from_url(url, file_type)
 
+    # Resume state carried across retry attempts. Bytes actually written are
+    # tracked explicitly because preallocation extends st_size to the full
+    # Content-Length, so the file size overstates progress after a mid-body
+    # failure
+    filepath = None
+    partial_path = None
+    supports_ranges = False
+    valid_bytes = 0
+    use_range_split = True  # Cleared when a server ignores Range requests
+
     for attempt in range(RETRY_ATTEMPTS):
         try:
-            # Make request with streaming for large files
-            response = requests.get(
-                url,
-                headers=HEADERS,
-                timeout=TIMEOUT,
-                stream=True,
-                allow_redirects=True
-            )
-            response.raise_for_status()
-
-            # Get actual extension from response
-            actual_ext = get_extension_from_response(response, expected_ext)
-            filename = f"{base_name}{actual_ext}"
-            filepath = region_dir / filename
-
-            # Handle duplicate filenames
-            counter = 1
-            while filepath.exists():
-                filename = f"{base_name}_{counter}{actual_ext}"
-                filepath = region_dir / filename
-                counter += 1
-
-            # Download file
-            total_size = 0
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                    if chunk:
-                        f.write(chunk)
-                        total_size += len(chunk)
-
-            result["success"] = True
-            result["filename"] = str(filepath.relative_to(output_dir.parent))
-            result["size"] = total_size
-
-            print(f"  [OK] {hospital_name}: {filename} ({total_size:,} bytes)")
-            return result
-
-        except requests.exceptions.Timeout:
+            attempt_headers = dict(request_headers)
+
+            # If a previous attempt left a partial file and the server
+            # advertises range support, continue from where it stopped
+            resume_from = 0
+            if supports_ranges and partial_path is not None and partial_path.exists():
+                resume_from = valid_bytes
+                if resume_from > 0:
+                    # Trim preallocated padding past the last written byte so
+                    # the 206 body appends at the right offset
+                    os.truncate(partial_path, resume_from)
+                    attempt_headers['Range'] = f'bytes={resume_from}-'
+
+            # Stream the response body so large files never sit in memory
+            async with client.stream('GET', url, headers=attempt_headers) as response:
+                if response.status_code == 304:
+                    result["success"] = True
+                    result["skipped"] = True
+                    result["filename"] = prior.get('filename')
+                    result["etag"] = prior.get('etag')
+                    result["last_modified"] = prior.get('last_modified')
+                    result["sha256"] = prior.get('sha256')
+                    print(f"  [SKIP] {hospital_name}: unchanged since last run (304)")
+                    return result
+
+                if response.status_code >= 400:
+                    # Drain the (small) error body before raising so the
+                    # connection goes back to the pool for the retry instead
+                    # of being torn down and re-handshaken
+                    await response.aread()
+                response.raise_for_status()
+
+                # Byte ranges address the *encoded* representation, while the
+                # bytes we count are decoded, so resuming (or range-splitting)
+                # a compressed body would request garbage offsets and feed the
+                # decoder a mid-stream fragment. Restart those from byte 0.
+                supports_ranges = (
+                    response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+                    and response.headers.get('Content-Encoding', 'identity') == 'identity'
+                )
+
+                body_iter = response.aiter_bytes(CHUNK_SIZE)
+
+                head = b''
+                if filepath is None:
+                    # Peek the first chunk and sniff the real file type from
+                    # its bytes, falling back to the Content-Type header
+                    async for chunk in body_iter:
+                        head = chunk
+                        break
+                    actual_ext = sniff_extension(
+                        head, get_extension_from_response(response, expected_ext)
+                    )
+
+                    # Claim the final filename atomically: O_EXCL either
+                    # creates a placeholder or reports the name taken, with
+                    # no exists()/create race between concurrent tasks
+                    counter = 0
+                    while True:
+                        suffix = '' if counter == 0 else f'_{counter}'
+                        filepath = region_dir / f"{base_name}{suffix}{actual_ext}"
+                        try:
+                            fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                        except FileExistsError:
+                            counter += 1
+                            continue
+                        os.close(fd)
+                        break
+
+                    partial_path = filepath.with_suffix(filepath.suffix + '.partial')
+
+                # 206 means the server honored the Range header: append to
+                # the partial file; anything else restarts from byte 0
+                if response.status_code == 206:
+                    mode, total_size = 'ab', resume_from
+                else:
+                    mode, total_size = 'wb', 0
+                valid_bytes = total_size
+
+                content_length = int(response.headers.get('Content-Length') or 0)
+                if (use_range_split and response.status_code == 200 and supports_ranges
+                        and content_length > LARGE_FILE_THRESHOLD):
+                    # Large file on a range-capable server: abandon this
+                    # stream and fetch parallel byte-range chunks instead.
+                    # Chunks land out of order, so no streaming digest here;
+                    # the rerun check falls back to existence only.
+                    await response.aclose()
+                    try:
+                        total_size = await download_ranges(
+                            client, url, request_headers, partial_path, content_length
+                        )
+                    except RangeNotHonoredError:
+                        # Advertising Accept-Ranges but answering 200 is
+                        # RFC-legal; stop splitting and let the remaining
+                        # attempts download over a single stream
+                        use_range_split = False
+                        raise
+                else:
+                    # Download to the partial file, then commit with a rename,
+                    # hashing inline so integrity info costs no second pass
+                    hasher = hashlib.sha256()
+                    if mode == 'ab' and resume_from > 0:
+                        # The digest must also cover the bytes already on disk
+                        hash_file(partial_path, hasher)
+
+                    # Preallocate the known final size so the filesystem is
+                    # not allocating blocks piecemeal during the stream. Only
+                    # for uncompressed bodies, where Content-Length is the
+                    # real on-disk size; done after open so 'wb' truncation
+                    # cannot discard the reservation.
+                    preallocated = (
+                        mode == 'wb' and content_length > 0
+                        and response.headers.get('Content-Encoding', 'identity') == 'identity'
+                        and hasattr(os, 'posix_fallocate')
+                    )
+
+                    async with aiofiles.open(partial_path, mode, buffering=CHUNK_SIZE) as f:
+                        if preallocated:
+                            prealloc_fd = os.open(partial_path, os.O_WRONLY)
+                            try:
+                                os.posix_fallocate(prealloc_fd, 0, content_length)
+                            finally:
+                                os.close(prealloc_fd)
+
+                        if head:
+                            hasher.update(head)
+                            await f.write(head)
+                            total_size += len(head)
+                            valid_bytes = total_size
+                        async for chunk in body_iter:
+                            hasher.update(chunk)
+                            await f.write(chunk)
+                            total_size += len(chunk)
+                            valid_bytes = total_size
+
+                    # Trim any reservation the body did not fill
+                    if preallocated and total_size < content_length:
+                        os.truncate(partial_path, total_size)
+
+                    result["sha256"] = hasher.hexdigest()
+
+                os.replace(partial_path, filepath)
+
+                # Freshly written pages won't be re-read by this process
+                drop_page_cache(filepath)
+
+                result["success"] = True
+                result["filename"] = str(filepath.relative_to(output_dir.parent))
+                result["size"] = total_size
+                result["etag"] = response.headers.get('ETag')
+                result["last_modified"] = response.headers.get('Last-Modified')
+
+                print(f"  [OK] {hospital_name}: {filepath.name} ({total_size:,} bytes, {response.http_version})")
+                return result
+
+        except httpx.TimeoutException:
             result["error"] = f"Timeout after {TIMEOUT}s (attempt {attempt + 1}/{RETRY_ATTEMPTS})"
             if attempt < RETRY_ATTEMPTS - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
 
-        except requests.exceptions.HTTPError as e:
-            result["error"] = f"HTTP {e.response.status_code}: {e.response.reason}"
-            break  # Don't retry HTTP errors
+        except httpx.HTTPStatusError as e:
+            result["error"] = f"HTTP {e.response.status_code}: {e.response.reason_phrase}"
+            if e.response.status_code in RETRYABLE_STATUSES:
+                if attempt < RETRY_ATTEMPTS - 1:
+                    await asyncio.sleep(2 ** attempt)
+                continue
+            break  # Don't retry other HTTP errors
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             result["error"] = str(e)
             if attempt < RETRY_ATTEMPTS - 1:
-                time.sleep(2 ** attempt)
+                await asyncio.sleep(2 ** attempt)
 
         except Exception as e:
             result["error"] = f"Unexpected error: {str(e)}"
             break
 
+    # Remove the resume state and zero-byte placeholder of a download that
+    # exhausted its retries; resume is per-call, so the partial is dead weight
+    if partial_path is not None and partial_path.exists():
+        partial_path.unlink()
+    if filepath is not None and filepath.exists() and filepath.stat().st_size == 0:
+        filepath.unlink()
+
     print(f"  [FAIL] {hospital_name}: {result['error']}")
     return result
 
 
-def main():
+async def process_host_group(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, group: list, output_dir: Path, prior_log: dict, record_result) -> None:
+    """Download all files for a single host sequentially over one pooled connection."""
+    # Rate-limit requests to this host only; other hosts are unaffected
+    bucket = TokenBucket()
+    for hospital in group:
+        await bucket.acquire()
+
+        async with semaphore:
+            record_result(await download_file(
+                client=client,
+                hospital_name=hospital['hospital_name'],
+                url=hospital['mrf_download_url'],
+                file_type=hospital['file_type'],
+                region=hospital['region'],
+                output_dir=output_dir,
+                prior=prior_log.get((hospital['hospital_name'], hospital['mrf_download_url']))
+            ))
+
+
+async def main():
     """Main function to orchestrate downloads."""
     print("=" * 70)
     print("CMS Hospital Price Transparency File Downloader")
@@ -200,71 +596,108 @@ def main():
     output_dir.mkdir(parents=True, exist_ok=True)
     print(f"\nOutput directory: {output_dir}")
 
-    # Read CSV file
-    hospitals = []
+    # Group hospitals by hostname straight off the CSV reader, so all files
+    # from one origin are fetched back-to-back over the same connection
+    host_groups = defaultdict(list)
     with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            hospitals.append(row)
+        for row in csv.DictReader(f):
+            host_groups[urlparse(row['mrf_download_url']).netloc].append(row)
+
+    total_hospitals = sum(len(group) for group in host_groups.values())
+    print(f"Found {total_hospitals} hospitals across {len(host_groups)} hosts to download\n")
 
-    print(f"Found {len(hospitals)} hospitals to download\n")
+    # Load the previous run's log so unchanged files can be skipped via 304s
+    log_path = output_dir / "download_log.jsonl"
+    prior_log = load_prior_log(log_path)
+    if prior_log:
+        print(f"Loaded {len(prior_log)} prior downloads for conditional requests\n")
 
-    # Track results
-    results = []
+    # Track only counters and failures; full results stream to the log
     successful = 0
     failed = 0
+    skipped = 0
     total_bytes = 0
+    progress = 0
+    failures = []
 
     # Download files with progress
     print("Starting downloads...\n")
 
-    # Use sequential downloads to be polite to servers
-    for i, hospital in enumerate(hospitals, 1):
-        print(f"[{i}/{len(hospitals)}] Downloading {hospital['hospital_name']}...")
-
-        result = download_file(
-            hospital_name=hospital['hospital_name'],
-            url=hospital['mrf_download_url'],
-            file_type=hospital['file_type'],
-            region=hospital['region'],
-            output_dir=output_dir
-        )
-
-        results.append(result)
-
-        if result['success']:
-            successful += 1
-            total_bytes += result['size']
-        else:
-            failed += 1
-
-        # Small delay between requests to be respectful
-        if i < len(hospitals):
-            time.sleep(DELAY_BETWEEN_REQUESTS)
+    # One task per host group: hosts download in parallel (capped by the
+    # semaphore), while requests to any single host stay sequential (and
+    # delayed) for politeness
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
+    install_dns_cache()
+
+    # Append to the JSONL log so records from interrupted runs survive
+    with open(log_path, 'ab') as log_fh:
+
+        def record_result(result):
+            """Stream each result to the log as it completes; keep counters only."""
+            nonlocal successful, failed, skipped, total_bytes, progress
+            progress += 1
+            print(f"[{progress}/{total_hospitals}] {result['hospital']}")
+
+            if result['success']:
+                successful += 1
+                total_bytes += result['size']
+                if result['skipped']:
+                    skipped += 1
+            else:
+                failed += 1
+                failures.append((result['hospital'], result['error']))
+
+            # Flush per record so the log survives a crash mid-run;
+            # fsync in batches to keep the durability cost off the hot path
+            log_fh.write(orjson.dumps(result) + b'\n')
+            log_fh.flush()
+            if progress % LOG_FSYNC_EVERY == 0:
+                os.fsync(log_fh.fileno())
+
+        async with create_client() as client:
+            await asyncio.gather(*[
+                process_host_group(client, semaphore, group, output_dir, prior_log, record_result)
+                for group in host_groups.values()
+            ])
 
     # Print summary
     print("\n" + "=" * 70)
     print("DOWNLOAD SUMMARY")
     print("=" * 70)
-    print(f"Total hospitals: {len(hospitals)}")
+    print(f"Total hospitals: {total_hospitals}")
     print(f"Successful downloads: {successful}")
+    print(f"Skipped (unchanged): {skipped}")
     print(f"Failed downloads: {failed}")
     print(f"Total data downloaded: {total_bytes / (1024*1024):.2f} MB")
 
     # List failed downloads
     if failed > 0:
         print("\nFailed downloads:")
-        for result in results:
-            if not result['success']:
-                print(f"  - {result['hospital']}: {result['error']}")
-
-    # Save results log
-    log_path = output_dir / "download_log.csv"
-    with open(log_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=['hospital', 'url', 'success', 'filename', 'size', 'error'])
+        for hospital, error in failures:
+            print(f"  - {hospital}: {error}")
+
+    # Convert the append-only JSONL into a CSV summary (latest entry per
+    # file), committed with an atomic rename
+    summary_path = output_dir / "download_log.csv"
+    summary_tmp = summary_path.with_suffix('.csv.tmp')
+    latest = {}
+    with open(log_path, 'rb') as src:
+        for line in src:
+            line = line.strip()
+            if line:
+                entry = orjson.loads(line)
+                latest[(entry['hospital'], entry['url'])] = entry
+    with open(summary_tmp, 'w', newline='', encoding='utf-8') as dst:
+        writer = csv.DictWriter(
+            dst,
+            fieldnames=['hospital', 'url', 'success', 'skipped', 'filename', 'size', 'etag', 'last_modified', 'sha256', 'error'],
+            extrasaction='ignore'
+        )
         writer.writeheader()
-        writer.writerows(results)
-    print(f"\nDownload log saved to: {log_path}")
+        writer.writerows(latest.values())
+    os.replace(summary_tmp, summary_path)
+
+    print(f"\nDownload log saved to: {log_path} (CSV summary: {summary_path})")
 
     # List downloaded files by region
     print("\nFiles by region:")
@@ -281,4 +714,4 @@ def main():
 
 
 if __name__ == "__main__":
-    exit(main())
+    exit(asyncio.run(main()))
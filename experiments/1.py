@@ -8,9 +8,18 @@ Output: bay_area_hospitals_with_cms_pages.csv
 
 from __future__ import annotations
 
+import shutil
+from pathlib import Path
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import requests
 
+# Local copy of the CMS CSV; delete it to force a fresh download
+CACHE_FILE = Path("hospital_general_information.csv")
+
 BAY_AREA_COUNTIES = {
     "ALAMEDA",
     "CONTRA COSTA",
@@ -29,16 +38,35 @@ METASTORE_URL = (
     "xubh-q36u?show-reference-ids=false"
 )
 
-meta = requests.get(METASTORE_URL, timeout=60)
+session = requests.Session()
+
+meta = session.get(METASTORE_URL, timeout=60)
 meta.raise_for_status()
 meta_json = meta.json()
 
 # CMS returns the CSV download URL under distribution[0]["data"]
 csv_url = meta_json["distribution"][0]["data"]["downloadURL"]
 
-# 2) Load CSV (Facility ID is the CMS Certification Number / CCN; keep as string)
-df = pd.read_csv(csv_url, dtype=str)
-
+# 2) Download the CSV once to a local cache, then parse with pyarrow's
+# vectorized C++ reader (much faster than pandas' dtype=str path).
+# Identifier-like columns stay strings so leading zeros survive.
+if not CACHE_FILE.exists():
+    with session.get(csv_url, stream=True, timeout=120) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(CACHE_FILE, "wb") as f:
+            shutil.copyfileobj(r.raw, f)
+
+table = pacsv.read_csv(
+    CACHE_FILE,
+    convert_options=pacsv.ConvertOptions(
+        column_types={
+            "Facility ID": pa.string(),
+            "ZIP Code": pa.string(),
+            "Telephone Number": pa.string(),
+        }
+    ),
+)
 # Common column names in this dataset (as of recent releases)
 # - 'Facility ID' (CCN)
 # - 'Facility Name'
@@ -46,16 +74,21 @@ df = pd.read_csv(csv_url, dtype=str)
 # - 'State'
 # - 'County/Parish'
 # If your download has slightly different headers, adjust below.
-df.columns = [c.strip() for c in df.columns]
-
-# 3) Filter to CA + Bay Area counties
-df["State"] = df["State"].str.strip()
-df["County/Parish"] = df["County/Parish"].str.strip().str.upper()
-
-bay = df[
-    (df["State"] == "CA")
-    & (df["County/Parish"].isin(BAY_AREA_COUNTIES))
-].copy()
+table = table.rename_columns([c.strip() for c in table.column_names])
+
+# 3) Filter to CA + Bay Area counties with Arrow compute kernels — the
+# whole pass runs vectorized in C++, and only the matching rows are
+# converted to pandas below
+state = pc.utf8_trim_whitespace(table["State"])
+county = pc.utf8_upper(pc.utf8_trim_whitespace(table["County/Parish"]))
+table = table.set_column(table.schema.get_field_index("State"), "State", state)
+table = table.set_column(table.schema.get_field_index("County/Parish"), "County/Parish", county)
+
+mask = pc.and_(
+    pc.equal(table["State"], "CA"),
+    pc.is_in(table["County/Parish"], value_set=pa.array(sorted(BAY_AREA_COUNTIES))),
+)
+bay = table.filter(mask).to_pandas()
 
 # 4) Build Medicare.gov (CMS) Care Compare hospital page URLs
 # Medicare.gov uses 6-digit CCNs; some datasets have leading zeros already, some don’t.